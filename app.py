@@ -2,30 +2,99 @@
 import pandas as pd
 import numpy as np
 import streamlit as st
+import xlsxwriter
 import io
-import re
 from datetime import datetime
 
+# pandas 3 always copies on write; opt in on 2.x so slices and renames stay lazy
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.options.mode.copy_on_write = True
+
+# Arrow-backed strings keep join keys in contiguous buffers (no per-row objects)
+try:
+    import pyarrow  # noqa: F401
+    _STR_DTYPE = pd.StringDtype('pyarrow')
+except ImportError:
+    _STR_DTYPE = pd.StringDtype()
+
 # -----------------------------
 # Light, fast helpers
 # -----------------------------
-def normalize_dni_value(x):
-    """Normalize DNI to digits only (e.g., '12345678.0' -> '12345678')."""
-    if pd.isna(x):
-        return np.nan
-    s = str(x).strip()
-    if re.match(r'^\d+\.0$', s):
-        s = s[:-2]
-    s = re.sub(r'\D', '', s)
-    return s if s else np.nan
+# Patterns stay plain strings with explicit classes: Arrow's RE2 kernels reject
+# compiled patterns and their \s and \d are ASCII-only, while Excel names
+# often carry NBSP. The same patterns behave identically under Python's re.
+_OTHER_SPACE = '\t\n\r\f\v\u00a0\u2000-\u200a\u202f\u3000'
+_DNI_TRAIL = r'\.0$'
+_NON_DIGIT = r'[^0-9]+'
+_WHITESPACE = f'[ {_OTHER_SPACE}]+'
+_WHITESPACE_FIX = f'[ {_OTHER_SPACE}]{{2}}|[{_OTHER_SPACE}]'  # runs, tabs, newlines, NBSP
+_YEAR_RE = r'(20[0-9]{2})'
+
+def normalize_dni_series(s):
+    """Normalize a DNI column read as text to digits only (e.g., '12345678.0' -> '12345678')."""
+    s = s.astype(_STR_DTYPE).str.strip()
+    s = s.str.replace(_DNI_TRAIL, '', regex=True)
+    return s.str.replace(_NON_DIGIT, '', regex=True).replace('', pd.NA)
+
+def dni_key(s):
+    """Join key for a normalized DNI: numeric Excel cells cannot keep leading
+    zeros, so '01234567' and '1234567' must meet. Never shown or exported."""
+    return s.str.lstrip('0').replace('', pd.NA)
+
+def open_excel(data):
+    """Open a workbook once from bytes, preferring the fast calamine reader."""
+    try:
+        return pd.ExcelFile(io.BytesIO(data), engine='calamine')
+    except ImportError:
+        # let pandas pick the reader from the content (openpyxl for .xlsx, xlrd for .xls)
+        return pd.ExcelFile(io.BytesIO(data))
 
 def clean_series(s):
-    return s.astype(str).str.replace(r'\s+', ' ', regex=True).str.strip()
-
+    """Collapse inner whitespace and strip; the regex rewrite only runs if needed."""
+    s = s.astype(_STR_DTYPE)
+    if s.str.contains(_WHITESPACE_FIX, regex=True).any():
+        s = s.str.replace(_WHITESPACE, ' ', regex=True)
+    return s.str.strip()
+
+def share_categories(frames, cols):
+    """Cast join key columns of several frames to one shared categorical dtype."""
+    for c in cols:
+        cats = pd.CategoricalDtype(pd.concat([f[c] for f in frames]).dropna().unique())
+        for f in frames:
+            f[c] = f[c].astype(cats)
+
+def with_name_keys(df, drop_names=False):
+    """Add case-insensitive Nombre/Apellido(s) match keys ('PÉREZ' == 'Pérez')."""
+    out = df.assign(_nombre_key=df['Nombre'].str.lower(), _apellido_key=df['Apellido(s)'].str.lower())
+    return out.drop(columns=['Nombre', 'Apellido(s)']) if drop_names else out
+
+def mean_by_key(df, keys):
+    """Collapse a lookup sheet to one row per key, averaging repeated scores."""
+    vals = [c for c in df.columns if c not in keys]
+    df = df.assign(**{c: pd.to_numeric(df[c], errors='coerce') for c in vals})
+    return df.groupby(keys, as_index=False, sort=False, observed=True)[vals].mean()
+
+@st.cache_data(show_spinner=False, max_entries=4, ttl=3600)
 def load_teacher_contract_from_bytes(contract_bytes):
     """Read minimal columns from the teacher contract, robust to header variants."""
-    xf = pd.ExcelFile(io.BytesIO(contract_bytes))
-    df = xf.parse(0)  # first sheet
+    dni_options = [
+        'N° DE DOCUMENTO DE IDENTIDAD', 'N° DE DOCUMENTO DE IDENTIDAD ',
+        'NRO DE DOCUMENTO DE IDENTIDAD', 'NRO DE DOCUMENTO', 'NRO DE DOCUMENTO'
+    ]
+    name_options = {'NOMBRES', 'Nombres', 'APELLIDO PATERNO', 'Apellido Paterno',
+                    'APELLIDO MATERNO', 'Apellido Materno'}
+
+    def is_dni_header(c):
+        s = str(c).upper()
+        return 'DOCUMENTO' in s and 'IDENTIDAD' in s
+
+    # Contracts carry many HR columns; only convert the ones we might pick
+    def wanted(c):
+        s = str(c).strip()
+        return s in name_options or s in dni_options or is_dni_header(c)
+
+    with open_excel(contract_bytes) as xf:
+        df = xf.parse(0, usecols=wanted, dtype='string')  # first sheet; keeps DNIs as text
     # Build a case-insensitive lookup over raw columns
     raw_cols = {str(c).strip(): c for c in df.columns}
     def find_col(options):
@@ -34,15 +103,11 @@ def load_teacher_contract_from_bytes(contract_bytes):
                 return raw_cols[opt]
         # fallback: fuzzy search
         for c in df.columns:
-            s = str(c).upper()
-            if 'DOCUMENTO' in s and 'IDENTIDAD' in s:
+            if is_dni_header(c):
                 return c
         return None
 
-    dni_col = find_col([
-        'N° DE DOCUMENTO DE IDENTIDAD', 'N° DE DOCUMENTO DE IDENTIDAD ',
-        'NRO DE DOCUMENTO DE IDENTIDAD', 'NRO DE DOCUMENTO', 'NRO DE DOCUMENTO'
-    ])
+    dni_col = find_col(dni_options)
     name_col   = raw_cols.get('NOMBRES', raw_cols.get('Nombres', None))
     a_pat_col  = raw_cols.get('APELLIDO PATERNO', raw_cols.get('Apellido Paterno', None))
     a_mat_col  = raw_cols.get('APELLIDO MATERNO', raw_cols.get('Apellido Materno', None))
@@ -51,132 +116,148 @@ def load_teacher_contract_from_bytes(contract_bytes):
         return pd.DataFrame(columns=['DNI', 'Nombre', 'Apellido(s)'])
 
     out = pd.DataFrame({
-        'DNI': df[dni_col].apply(normalize_dni_value),
+        'DNI': normalize_dni_series(df[dni_col]),
         'Nombre': clean_series(df[name_col]),
-        'Apellido(s)': clean_series(df[a_pat_col]) + ' ' + clean_series(df[a_mat_col])
+        'Apellido(s)': (clean_series(df[a_pat_col])
+                        .str.cat(clean_series(df[a_mat_col]), sep=' ', na_rep='')
+                        .str.strip().replace('', pd.NA))
     })
-    out = out.dropna(subset=['DNI'])
-    out = out[out['DNI'] != ''].drop_duplicates(subset=['DNI'])
+    # An all-zero placeholder DNI has no key; keeping it would let the inner
+    # join match every blank DNI on the master sheets
+    key = dni_key(out['DNI'])
+    out = out[key.notna() & ~key.duplicated()]
     return out[['DNI', 'Nombre', 'Apellido(s)']]
 
 # -----------------------------
 # Core processing (vectorized & trimmed)
 # -----------------------------
 def extract_data_from_excel_bytes(master_bytes, contract_bytes=None):
-    xf = pd.ExcelFile(io.BytesIO(master_bytes))
-
-    # 1) Base from Inducción + nota Inducción
-    induccion = xf.parse('Inducción', usecols=['Periodo', 'DNI', 'Nombre', 'Apellido(s)', 'Dirección de correo', 'Calificación'])
-    induccion = induccion.rename(columns={'Calificación': 'induccion'})
-    nota_ind = xf.parse('nota Inducción', usecols=['PERIODO', 'DNI', 'Nombre', 'Apellido(s)', 'Dirección de correo', 'Total del curso (Real)'])
-    nota_ind = nota_ind.rename(columns={'PERIODO': 'Periodo', 'Total del curso (Real)': 'induccion'})
-    all_data = pd.concat([nota_ind, induccion], ignore_index=True)
-
-    # Normalize IDs & names
-    all_data['DNI'] = all_data['DNI'].apply(normalize_dni_value)
-    all_data['Nombre'] = clean_series(all_data['Nombre'])
-    all_data['Apellido(s)'] = clean_series(all_data['Apellido(s)'])
-
-    # Vectorized Year from Periodo (handles '2024', '2024-I', etc.)
-    all_data['Year'] = (
-        all_data['Periodo'].astype(str)
-        .str.extract(r'(20\d{2})', expand=False)
-        .astype('Int64')
+    # Parse every sheet inside one with-block so the workbook is always released
+    with open_excel(master_bytes) as xf:
+        # 1) Base from Inducción + nota Inducción
+        induccion = xf.parse('Inducción', usecols=['Periodo', 'DNI', 'Nombre', 'Apellido(s)', 'Calificación'],
+                             dtype={'DNI': 'string'})
+        induccion.rename(columns={'Calificación': 'induccion'}, inplace=True)
+        nota_ind = xf.parse('nota Inducción', usecols=['PERIODO', 'DNI', 'Nombre', 'Apellido(s)', 'Total del curso (Real)'],
+                            dtype={'DNI': 'string'})
+        nota_ind.rename(columns={'PERIODO': 'Periodo', 'Total del curso (Real)': 'induccion'}, inplace=True)
+        all_data = pd.concat([nota_ind, induccion], ignore_index=True)
+
+        # Normalize IDs & names
+        all_data['DNI'] = normalize_dni_series(all_data['DNI'])
+        all_data['_dni_key'] = dni_key(all_data['DNI'])
+        all_data['Nombre'] = clean_series(all_data['Nombre'])
+        all_data['Apellido(s)'] = clean_series(all_data['Apellido(s)'])
+
+        # Vectorized Year from Periodo (handles '2024', '2024-I', etc.)
+        all_data['Year'] = (
+            all_data['Periodo'].astype('string')
+            .str.extract(_YEAR_RE, expand=False)
+            .astype('Int16')
+        )
+        # Only keep periods we care about before any join touches the rows
+        all_data = all_data[all_data['Year'].isin([2024, 2025])]
+
+        # 2) Optionally restrict to DNIs in Teacher Contract early (shrinks work)
+        #    and fill missing names from it in the same indexed join
+        if contract_bytes is not None:
+            contract = load_teacher_contract_from_bytes(contract_bytes)
+            if not contract.empty:
+                contract_names = contract.set_index(dni_key(contract['DNI']))[['Nombre', 'Apellido(s)']]
+                all_data = all_data.join(contract_names, on='_dni_key', how='inner', rsuffix='_c', validate='m:1')
+                all_data['Nombre'] = all_data['Nombre'].fillna(all_data.pop('Nombre_c'))
+                all_data['Apellido(s)'] = all_data['Apellido(s)'].fillna(all_data.pop('Apellido(s)_c'))
+
+        # If nothing left, stop early
+        if all_data.empty:
+            return pd.DataFrame()
+
+        # 3) Bring in the rest, reading only necessary cols and trimming to relevant DNIs where possible
+        # DNI sheets only feed the join, so their DNI column holds the join key
+        needed_dnis = pd.Index(all_data['_dni_key'].dropna().unique())
+
+        # Bus. biblioteca (by DNI)
+        bus_bib = xf.parse('Bus. biblioteca', usecols=['DNI', 'Promedio'], dtype={'DNI': 'string'})
+        bus_bib.rename(columns={'Promedio': 'bus_biblioteca'}, inplace=True)
+        bus_bib['DNI'] = dni_key(normalize_dni_series(bus_bib['DNI']))
+        if len(needed_dnis):
+            bus_bib = bus_bib[bus_bib['DNI'].isin(needed_dnis)]
+
+        # RSU (by DNI)
+        rsu = xf.parse('RSU', usecols=['DNI', 'Tarea: Producto final'], dtype={'DNI': 'string'})
+        rsu.rename(columns={'Tarea: Producto final': 'rsu'}, inplace=True)
+        rsu['DNI'] = dni_key(normalize_dni_series(rsu['DNI']))
+        if len(needed_dnis):
+            rsu = rsu[rsu['DNI'].isin(needed_dnis)]
+
+        # estress (by DNI)
+        est = xf.parse('estress', usecols=['DNI', 'Tarea:Producto final'], dtype={'DNI': 'string'})
+        est.rename(columns={'Tarea:Producto final': 'estress'}, inplace=True)
+        est['DNI'] = dni_key(normalize_dni_series(est['DNI']))
+        if len(needed_dnis):
+            est = est[est['DNI'].isin(needed_dnis)]
+
+        # Hab. comunicación (by DNI)
+        hab = xf.parse('Hab. comunicación', usecols=['DNI', 'Tarea:Producto final'], dtype={'DNI': 'string'})
+        hab.rename(columns={'Tarea:Producto final': 'hab_comunicacion'}, inplace=True)
+        hab['DNI'] = dni_key(normalize_dni_series(hab['DNI']))
+        if len(needed_dnis):
+            hab = hab[hab['DNI'].isin(needed_dnis)]
+
+        # Diseño de sesión (by names)
+        dis_ses = xf.parse('Diseño de sesión', usecols=['Nombre', 'Apellido(s)', 'Promedio'])
+        dis_ses.rename(columns={'Promedio': 'diseno_sesion'}, inplace=True)
+        dis_ses['Nombre'] = clean_series(dis_ses['Nombre'])
+        dis_ses['Apellido(s)'] = clean_series(dis_ses['Apellido(s)'])
+
+        # Comp. Tec (by names)
+        comp_map = {
+            'Cuestionario:Reto: Zoom básico': 'Zoom_basico',
+            'Cuestionario:Reto: Zoom Avanzado': 'Zoom_Avanzado',
+            'Cuestionario:Reto: Grupos Moodle': 'Grupos_Moodle',
+            'Cuestionario:Reto: Rúbrica': 'Rubrica',
+            'Cuestionario:Reto: Padlet': 'Padlet',
+            'Cuestionario:Reto: Nearpod': 'Nearpod',
+            'Cuestionario:Reto: Tareas y foros': 'Tareas_y_foros'
+        }
+        comp = xf.parse('Comp. Tec', usecols=lambda c: c in ('Nombre', 'Apellido(s)') or c in comp_map)
+        comp.rename(columns=comp_map, inplace=True)
+        comp['Nombre'] = clean_series(comp['Nombre'])
+        comp['Apellido(s)'] = clean_series(comp['Apellido(s)'])
+
+        # Integración (by names)
+        integ_col = 'Tarea:Producto final: Contenido académico, presentación y rúbrica con IA (Real)'
+        integ = xf.parse('Integración', usecols=lambda c: c in ('Nombre', 'Apellido(s)', integ_col))
+        if integ_col in integ.columns:
+            integ.rename(columns={integ_col: 'integracion'}, inplace=True)
+            integ['Nombre'] = clean_series(integ['Nombre'])
+            integ['Apellido(s)'] = clean_series(integ['Apellido(s)'])
+        else:
+            integ = None
+
+    # Pre-join the lookup sheets, then merge each side into all_data once.
+    # Names match case-insensitively on shared int category codes built once;
+    # all_data keeps the names as written for display.
+    name_keys = ['_nombre_key', '_apellido_key']
+    all_data = with_name_keys(all_data)
+    lookups = [with_name_keys(f, drop_names=True) for f in (dis_ses, comp, integ) if f is not None]
+    share_categories([all_data] + lookups, name_keys)
+    # One row per key on every lookup sheet, so no join can multiply rows;
+    # a name repeated on a sheet contributes the mean of its scores
+    lookups = [mean_by_key(f, name_keys) for f in lookups]
+    names_side = lookups[0]
+    for f in lookups[1:]:
+        names_side = names_side.merge(f, on=name_keys, how='outer', validate='1:1')
+    # DNI sheets follow the same rule: one averaged row per DNI, so they align
+    # on a unique index and one index join replaces a merge
+    dni_side = pd.concat(
+        [mean_by_key(f, ['DNI']).set_index('DNI') for f in (bus_bib, rsu, est, hab)],
+        axis=1,
     )
+    all_data = all_data.merge(names_side, on=name_keys, how='left', validate='m:1')
+    all_data = all_data.drop(columns=name_keys).join(dni_side, on='_dni_key', validate='m:1')
 
-    # 2) Optionally restrict to DNIs in Teacher Contract early (shrinks work)
-    contract = None
-    if contract_bytes is not None:
-        contract = load_teacher_contract_from_bytes(contract_bytes)
-        if not contract.empty:
-            dnis = set(contract['DNI'])
-            all_data = all_data[all_data['DNI'].isin(dnis)]
-
-    # If nothing left, stop early
-    if all_data.empty:
-        return pd.DataFrame()
-
-    # Convenience: only keep periods we care about asap
-    all_data = all_data[all_data['Year'].isin([2024, 2025])]
-
-    # 3) Bring in the rest, reading only necessary cols and trimming to relevant DNIs where possible
-    needed_dnis = set(all_data['DNI'].dropna())
-
-    # Bus. biblioteca (by DNI)
-    bus_bib = xf.parse('Bus. biblioteca', usecols=['DNI', 'Promedio'])
-    bus_bib['DNI'] = bus_bib['DNI'].apply(normalize_dni_value)
-    if needed_dnis:
-        bus_bib = bus_bib[bus_bib['DNI'].isin(needed_dnis)]
-    bus_bib = bus_bib.rename(columns={'Promedio': 'bus_biblioteca'})
-    all_data = all_data.merge(bus_bib, on='DNI', how='left')
-
-    # Diseño de sesión (by names)
-    dis_ses = xf.parse('Diseño de sesión', usecols=['Nombre', 'Apellido(s)', 'Promedio'])
-    dis_ses = dis_ses.rename(columns={'Promedio': 'diseno_sesion'})
-    dis_ses['Nombre'] = clean_series(dis_ses['Nombre'])
-    dis_ses['Apellido(s)'] = clean_series(dis_ses['Apellido(s)'])
-    all_data = all_data.merge(dis_ses, on=['Nombre', 'Apellido(s)'], how='left')
-
-    # Comp. Tec (by names)
-    comp = xf.parse('Comp. Tec')
-    comp_map = {
-        'Cuestionario:Reto: Zoom básico': 'Zoom_basico',
-        'Cuestionario:Reto: Zoom Avanzado': 'Zoom_Avanzado',
-        'Cuestionario:Reto: Grupos Moodle': 'Grupos_Moodle',
-        'Cuestionario:Reto: Rúbrica': 'Rubrica',
-        'Cuestionario:Reto: Padlet': 'Padlet',
-        'Cuestionario:Reto: Nearpod': 'Nearpod',
-        'Cuestionario:Reto: Tareas y foros': 'Tareas_y_foros'
-    }
-    keep_cols = ['Nombre', 'Apellido(s)'] + [k for k in comp_map.keys() if k in comp.columns]
-    comp = comp[keep_cols].rename(columns=comp_map)
-    comp['Nombre'] = clean_series(comp['Nombre'])
-    comp['Apellido(s)'] = clean_series(comp['Apellido(s)'])
-    all_data = all_data.merge(comp, on=['Nombre', 'Apellido(s)'], how='left')
-
-    # Integración (by names)
-    integ = xf.parse('Integración')
-    integ_col = 'Tarea:Producto final: Contenido académico, presentación y rúbrica con IA (Real)'
-    if integ_col in integ.columns:
-        integ = integ[['Nombre', 'Apellido(s)', integ_col]].rename(columns={integ_col: 'integracion'})
-        integ['Nombre'] = clean_series(integ['Nombre'])
-        integ['Apellido(s)'] = clean_series(integ['Apellido(s)'])
-        all_data = all_data.merge(integ, on=['Nombre', 'Apellido(s)'], how='left')
-    else:
-        all_data['integracion'] = np.nan
-
-    # RSU (by DNI)
-    rsu = xf.parse('RSU', usecols=['DNI', 'Tarea: Producto final'])
-    rsu['DNI'] = rsu['DNI'].apply(normalize_dni_value)
-    if needed_dnis:
-        rsu = rsu[rsu['DNI'].isin(needed_dnis)]
-    rsu = rsu.rename(columns={'Tarea: Producto final': 'rsu'})
-    all_data = all_data.merge(rsu, on='DNI', how='left')
-
-    # estress (by DNI)
-    est = xf.parse('estress', usecols=['DNI', 'Tarea:Producto final'])
-    est['DNI'] = est['DNI'].apply(normalize_dni_value)
-    if needed_dnis:
-        est = est[est['DNI'].isin(needed_dnis)]
-    est = est.rename(columns={'Tarea:Producto final': 'estress'})
-    all_data = all_data.merge(est, on='DNI', how='left')
-
-    # Hab. comunicación (by DNI)
-    hab = xf.parse('Hab. comunicación', usecols=['DNI', 'Tarea:Producto final'])
-    hab['DNI'] = hab['DNI'].apply(normalize_dni_value)
-    if needed_dnis:
-        hab = hab[hab['DNI'].isin(needed_dnis)]
-    hab = hab.rename(columns={'Tarea:Producto final': 'hab_comunicacion'})
-    all_data = all_data.merge(hab, on='DNI', how='left')
-
-    # 4) Fill names from contract (only where missing)
-    if contract is not None and not contract.empty:
-        all_data = all_data.merge(contract, on='DNI', how='left', suffixes=('', '_contract'))
-        all_data['Nombre'] = all_data['Nombre'].fillna(all_data['Nombre_contract'])
-        all_data['Apellido(s)'] = all_data['Apellido(s)'].fillna(all_data['Apellido(s)_contract'])
-        all_data = all_data.drop(columns=['Nombre_contract', 'Apellido(s)_contract'], errors='ignore')
-
-    # 5) Coerce numeric components (vectorized)
+    # 4) Coerce numeric components (vectorized)
     numeric_cols = [
         'induccion', 'bus_biblioteca', 'diseno_sesion',
         'Zoom_basico', 'Zoom_Avanzado', 'Grupos_Moodle', 'Rubrica',
@@ -186,26 +267,43 @@ def extract_data_from_excel_bytes(master_bytes, contract_bytes=None):
     for c in numeric_cols:
         if c not in all_data.columns:
             all_data[c] = np.nan
-    all_data[numeric_cols] = all_data[numeric_cols].apply(pd.to_numeric, errors='coerce').fillna(0)
+    # Only text-typed columns (e.g. '-' placeholders) need parsing; the rest cast directly
+    text_cols = [c for c in numeric_cols if not pd.api.types.is_numeric_dtype(all_data[c])]
+    if text_cols:
+        all_data[text_cols] = all_data[text_cols].apply(pd.to_numeric, errors='coerce')
+    # Grades are 0-20, so float32 halves the block without losing precision that matters
+    all_data[numeric_cols] = all_data[numeric_cols].astype(np.float32).fillna(0)
+
+    # Pull the score block out once (row-major) and reuse it for the filter and metrics
+    mat = np.ascontiguousarray(all_data[numeric_cols].to_numpy(dtype=np.float32))
+    # Sum in float64 from values rounded back to source precision, so averages
+    # on a half cent round as they did on the float64 sheet (36.33 / 14 -> 2.6)
+    row_sum = mat.astype(np.float64).round(5).sum(axis=1)
 
     # Keep only rows with any non-zero score
-    nonzero_mask = (all_data[numeric_cols].sum(axis=1) > 0)
-    all_data = all_data[nonzero_mask]
+    nonzero_mask = row_sum > 0
+    all_data, mat, row_sum = all_data[nonzero_mask], mat[nonzero_mask], row_sum[nonzero_mask]
     if all_data.empty:
         return pd.DataFrame()
 
     # Metrics (fully vectorized)
-    all_data['Average'] = all_data[numeric_cols].mean(axis=1).round(2)
-    non_zero_count = (all_data[numeric_cols] > 0).sum(axis=1)
-    all_data['Percentage'] = ((non_zero_count / len(numeric_cols)) * 100).round(2)
-    all_data['Marks_Out_Of_20'] = (all_data['Percentage'] / 5).round(2)
-
-    # 6) Dedup to ONE row per teacher (best of 2024 vs 2025)
-    # Prefer: higher Marks_Out_Of_20, then higher Average, then 2025
-    yearpref = (all_data['Year'] == 2025).astype(int)
-    all_data['_YearPref'] = yearpref
-    all_data = all_data.sort_values(by=['Marks_Out_Of_20', 'Average', '_YearPref'], ascending=[False, False, False])
-    highest = all_data.drop_duplicates(subset=['DNI'], keep='first').copy()
+    non_zero_count = (mat > 0).sum(axis=1)
+    all_data['Average'] = np.round(row_sum / len(numeric_cols), 2)
+    all_data['Percentage'] = np.round(non_zero_count * (100.0 / len(numeric_cols)), 2)
+    all_data['Marks_Out_Of_20'] = np.round(all_data['Percentage'].to_numpy() / 5, 2)
+
+    # 5) Dedup to ONE row per teacher (best of 2024 vs 2025)
+    # Prefer: higher Marks_Out_Of_20, then higher Average, then 2025.
+    # Both metrics are rounded to cents, so they pack exactly into one int key
+    # and idxmax per DNI replaces a full sort of every candidate row.
+    all_data['_score_key'] = (
+        np.rint(all_data['Marks_Out_Of_20'].to_numpy() * 100).astype(np.int64) * 1_000_000
+        + np.rint(all_data['Average'].to_numpy() * 100).astype(np.int64) * 10
+        + (all_data['Year'] == 2025).to_numpy(dtype=np.int64, na_value=0)
+    )
+    idx = all_data.groupby('_dni_key', sort=False, dropna=False)['_score_key'].idxmax()
+    highest = all_data.loc[idx].sort_values('_score_key', ascending=False, kind='stable')
+    highest = highest.drop(columns=['_score_key', '_dni_key'])
     highest['Highest_Score_Year'] = highest['Year']
 
     final_cols = [
@@ -218,13 +316,31 @@ def extract_data_from_excel_bytes(master_bytes, contract_bytes=None):
     ]
     # Some sheets may miss certain columns; guard selection
     final_cols = [c for c in final_cols if c in highest.columns]
+    # Widen back for export; rounding drops float32 noise (13.33 -> 13.329999923...)
+    highest[numeric_cols] = highest[numeric_cols].astype(np.float64).round(5)
     return highest[final_cols].reset_index(drop=True)
 
 # Optional caching (speeds re-runs with the same files during a session)
-@st.cache_data(show_spinner=False, ttl=3600)
+@st.cache_data(show_spinner=False, max_entries=4, ttl=3600)
 def process_cached(master_bytes, contract_bytes):
     return extract_data_from_excel_bytes(master_bytes, contract_bytes)
 
+def to_xlsx_bytes(df, sheet_name):
+    """Stream a DataFrame to an in-memory .xlsx, one row at a time."""
+    # pandas' to_excel emits cells column by column, which constant_memory
+    # (flush each finished row) would silently drop, so write rows directly.
+    # Header and datetime formats match what to_excel wrote before.
+    buf = io.BytesIO()
+    wb = xlsxwriter.Workbook(buf, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+    ws = wb.add_worksheet(sheet_name)
+    header = wb.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    ws.write_row(0, 0, [str(c) for c in df.columns], header)
+    for r, values in enumerate(df.itertuples(index=False, name=None), start=1):
+        ws.write_row(r, 0, [None if pd.isna(v) else v for v in values])
+    wb.close()
+    buf.seek(0)
+    return buf
+
 # -----------------------------
 # Streamlit App (lean UI)
 # -----------------------------
@@ -260,10 +376,7 @@ def main():
             # Download
             ts = datetime.now().strftime("%Y%m%d_%H%M%S")
             fname = f"Highest_Marks_2024_vs_2025_{ts}.xlsx"
-            buf = io.BytesIO()
-            with pd.ExcelWriter(buf, engine='openpyxl') as w:
-                final_df.to_excel(w, index=False, sheet_name='Highest Marks (Unique)')
-            buf.seek(0)
+            buf = to_xlsx_bytes(final_df, 'Highest Marks (Unique)')
             st.download_button("📥 Download", buf,
                                file_name=fname,
                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")